@@ -16,6 +16,9 @@ class EmulatorConfig:
     connection_timeout: int = 300
     request_timeout: int = 300
     client_ramp_delay_ms: int = 0
+    max_concurrent_clients: int = 50
+    http2: bool = True
+    use_msgpack: bool = True
 
     jwt_secret: str = "super-secret-jwt-key"
     centrifugo_api_key: str = "super-secret-api-key"
@@ -30,4 +33,7 @@ class EmulatorConfig:
             connection_timeout=int(os.getenv('CONNECTION_TIMEOUT', '30')),
             request_timeout=int(os.getenv('REQUEST_TIMEOUT', '120')),
             client_ramp_delay_ms=int(os.getenv('CLIENT_RAMP_DELAY_MS', '0')),
+            max_concurrent_clients=int(os.getenv('MAX_CONCURRENT_CLIENTS', '50')),
+            http2=os.getenv('HTTP2', 'true').lower() == 'true',
+            use_msgpack=os.getenv('USE_MSGPACK', 'true').lower() == 'true',
         )
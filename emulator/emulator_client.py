@@ -1,16 +1,19 @@
 import asyncio
+from array import array
 import logging
 import time
+from collections import deque
 from typing import Optional
 import httpx
+import orjson
+import ormsgpack
 from centrifuge import (
     Client,
     ClientEventHandler,
-    SubscriptionEventHandler,
+    ClientState,
     ConnectedContext,
     DisconnectedContext,
     ErrorContext,
-    PublicationContext,
     ServerPublicationContext,
 )
 from centrifuge.codes import _DisconnectedCode
@@ -21,140 +24,267 @@ from emulator.statistics import ClientStats
 
 logger = logging.getLogger(__name__)
 
+_now = time.monotonic_ns
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Slots of the run-wide progress counters array('Q', [cycles, tokens, errors]).
+PROGRESS_CYCLES, PROGRESS_TOKENS, PROGRESS_ERRORS = range(3)
+
+
+def new_progress_counters() -> array:
+    return array("Q", [0, 0, 0])
+
+
+class ConnectGate:
+    """Admission gate: at most `limit` holders at a time, resizable while waiters queue.
+
+    A counter under an asyncio.Condition rather than a Semaphore, so the limit can change
+    at runtime; each release wakes a single waiter.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify(1)
+
+    async def resize(self, limit: int):
+        async with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class ClientEvents(ClientEventHandler):
+    def __init__(self, client: "EmulatorClient"):
+        self.client = client
+
+    async def on_connected(self, ctx: ConnectedContext) -> None:
+        self.client.connected_event.set()
+        logger.info("Client connected successfully. [client_id=%s, session_id=%s]", self.client.client_id, self.client.session_id)
+
+    async def on_disconnected(self, ctx: DisconnectedContext) -> None:
+        client = self.client
+        logger.info(
+            "Client disconnected. [client_id=%s, session_id=%s, code=%s, reason=%s]",
+            client.client_id,
+            client.session_id,
+            ctx.code,
+            ctx.reason,
+        )
+        code = ctx.code
+        disconnect_called = (
+            code == _DisconnectedCode.DISCONNECT_CALLED
+            or (isinstance(code, int) and code == _DisconnectedCode.DISCONNECT_CALLED.value)
+        )
+        if not client.shutting_down and not disconnect_called:
+            client.stats.reconnection_count += 1
+        # A terminal disconnect during the handshake must not leave connect() waiting.
+        client.connected_event.set()
+
+    async def on_error(self, ctx: ErrorContext) -> None:
+        logger.error("Client error. [client_id=%s, session_id=%s, error=%s]", self.client.client_id, self.client.session_id, ctx.error)
+        self.client.stats.other_errors += 1
+        self.client.progress[PROGRESS_ERRORS] += 1
+
+    async def on_server_publication(self, ctx: ServerPublicationContext) -> None:
+        self.client.handle_publication(ctx.pub.data)
+
 
 class EmulatorClient:
-    def __init__(self, client_id: int, config: EmulatorConfig):
+    # HTTP clients shared by every emulated client in the process, picked by client_id.
+    _shared_http: list[httpx.AsyncClient] = []
+    # Caps how many clients are in the session-create/WebSocket handshake at once.
+    _connect_gate: Optional[ConnectGate] = None
+
+    @classmethod
+    def _shared_client(cls, config: EmulatorConfig, client_id: int) -> httpx.AsyncClient:
+        if not cls._shared_http:
+            if config.http2:
+                # h2c with prior knowledge. httpcore keeps sending new streams to one open
+                # HTTP/2 connection and queues them at the peer's stream limit instead of
+                # opening another, so every ~100 clients (HAProxy's default
+                # max-concurrent-streams) get their own single-connection AsyncClient.
+                num_http_clients = config.num_clients // 100 + 1
+                max_connections = 1
+            else:
+                num_http_clients = 1
+                max_connections = config.num_clients * 2
+            cls._shared_http = [
+                httpx.AsyncClient(
+                    base_url=config.haproxy_http_url,
+                    timeout=config.request_timeout,
+                    http1=not config.http2,
+                    http2=config.http2,
+                    limits=httpx.Limits(
+                        max_connections=max_connections,
+                        max_keepalive_connections=max_connections
+                    )
+                )
+                for _ in range(num_http_clients)
+            ]
+        return cls._shared_http[client_id % len(cls._shared_http)]
+
+    @classmethod
+    def _connect_slots(cls, config: EmulatorConfig) -> ConnectGate:
+        if cls._connect_gate is None:
+            cls._connect_gate = ConnectGate(config.max_concurrent_clients)
+        return cls._connect_gate
+
+    @classmethod
+    async def resize_connect_slots(cls, config: EmulatorConfig, limit: int):
+        await cls._connect_slots(config).resize(limit)
+
+    @classmethod
+    async def close_shared_client(cls):
+        # A later run in the same process starts from its own max_concurrent_clients.
+        cls._connect_gate = None
+        http_clients, cls._shared_http = cls._shared_http, []
+        for http_client in http_clients:
+            await http_client.aclose()
+
+    def __init__(self, client_id: int, config: EmulatorConfig, progress: Optional[array] = None):
         self.client_id = client_id
         self.config = config
+        # Run-wide counters shared with the orchestrator's progress log.
+        self.progress = progress if progress is not None else new_progress_counters()
+        self.ws_url = f"{config.haproxy_ws_url}/connection/websocket"
         self.session_id: Optional[str] = None
         self.token: Optional[str] = None
+        self.run_body_template: dict = {}
         self.centrifuge_client: Optional[Client] = None
         self.http_client: Optional[httpx.AsyncClient] = None
         self.stats = ClientStats(client_id=client_id, session_id="")
-        self.token_queue: asyncio.Queue = asyncio.Queue()
+        # Single producer (publication handler), single consumer (run_cycle).
+        self.token_buffer: deque[str] = deque()
+        self.token_event = asyncio.Event()
         self.done_event = asyncio.Event()
+        self.connected_event = asyncio.Event()
         self.shutting_down = False
 
     async def connect(self):
         try:
-            self.http_client = httpx.AsyncClient(
-                base_url=self.config.haproxy_http_url,
-                timeout=self.config.request_timeout
-            )
-
-            if not self.session_id:
-                response = await self.http_client.post("/api/sessions/create")
-                data = response.json()
-                self.session_id = data["session_id"]
-                self.token = data["token"]
-                self.stats.session_id = self.session_id
-
-            ws_url = f"{self.config.haproxy_ws_url}/connection/websocket"
-
-            class MyClientHandler(ClientEventHandler):
-                async def on_connected(handler_self, ctx: ConnectedContext) -> None:
-                    logger.info(f"Client connected successfully. [client_id=%s, session_id=%s]", self.client_id, self.session_id)
-
-                async def on_disconnected(handler_self, ctx: DisconnectedContext) -> None:
-                    logger.info(
-                        "Client disconnected. [client_id=%s, session_id=%s, code=%s, reason=%s]",
-                        self.client_id,
-                        self.session_id,
-                        ctx.code,
-                        ctx.reason,
-                    )
-                    code = ctx.code
-                    disconnect_called = (
-                        code == _DisconnectedCode.DISCONNECT_CALLED
-                        or (isinstance(code, int) and code == _DisconnectedCode.DISCONNECT_CALLED.value)
-                    )
-                    if not self.shutting_down and not disconnect_called:
-                        self.stats.reconnection_count += 1
-
-                async def on_error(handler_self, ctx: ErrorContext) -> None:
-                    logger.error(f"Client error. [client_id=%s, session_id=%s, error=%s]", self.client_id, self.session_id, ctx.error)
-                    self.stats.other_errors += 1
+            self.http_client = EmulatorClient._shared_client(self.config, self.client_id)
+
+            # Held only for the handshake so steady-state streaming is not capped.
+            async with EmulatorClient._connect_slots(self.config):
+                if not self.session_id:
+                    response = await self.http_client.post("/api/sessions/create")
+                    data = orjson.loads(response.content)
+                    self.session_id = data["session_id"]
+                    self.token = data["token"]
+                    self.stats.session_id = self.session_id
+                    self.run_body_template = {"session_id": self.session_id, "msgpack": self.config.use_msgpack}
+
+                # MessagePack payloads arrive as binary, which needs the protobuf protocol.
+                self.centrifuge_client = Client(
+                    self.ws_url,
+                    events=ClientEvents(self),
+                    token=self.token,
+                    use_protobuf=self.config.use_msgpack
+                )
+
+                # The token's channels claim subscribes us server-side on connect.
+                # A failed handshake leaves the SDK reconnecting in the background,
+                # so wait for on_connected rather than trusting connect() to succeed.
+                await self.centrifuge_client.connect()
+                # Non-temporary errors leave the SDK DISCONNECTED with no reconnect; fail
+                # fast so the connect slot goes to the next client.
+                if self.centrifuge_client.state == ClientState.DISCONNECTED:
+                    raise ConnectionError("connect rejected")
+                async with asyncio.timeout(self.config.connection_timeout):
+                    await self.connected_event.wait()
+                if self.centrifuge_client.state != ClientState.CONNECTED:
+                    raise ConnectionError("disconnected during connect")
 
-                async def on_server_publication(handler_self, ctx: ServerPublicationContext) -> None:
-                    data = ctx.pub.data
-                    logger.debug(f"Server publication received. [client_id=%s, session_id=%s]", self.client_id, self.session_id)
-
-                    if "token" in data:
-                        await self.token_queue.put(data["token"])
-                        self.stats.total_tokens_received += 1
-
-                    if data.get("done"):
-                        self.done_event.set()
+            return True
 
-            class MySubscriptionHandler(SubscriptionEventHandler):
-                async def on_publication(handler_self, ctx: PublicationContext) -> None:
-                    data = ctx.pub.data
-                    logger.debug(f"Publication received. [client_id=%s, session_id=%s]", self.client_id, self.session_id)
+        except Exception as e:
+            logger.error("Client connection failed. [client_id=%s, error=%s]", self.client_id, e)
+            self.stats.connection_errors += 1
+            self.progress[PROGRESS_ERRORS] += 1
+            return False
 
-                    if "token" in data:
-                        await self.token_queue.put(data["token"])
-                        self.stats.total_tokens_received += 1
+    def handle_publication(self, data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Publication received. [client_id=%s, session_id=%s]", self.client_id, self.session_id)
 
-                    if data.get("done"):
-                        self.done_event.set()
+        if isinstance(data, (bytes, bytearray)):
+            data = ormsgpack.unpackb(data)
 
-            self.centrifuge_client = Client(ws_url, events=MyClientHandler(), token=self.token)
+        if "ts" in data:
+            self.stats.delivery_latencies.append(time.time_ns() - data["ts"])
 
-            await self.centrifuge_client.connect()
+        tokens = data.get("tokens")
+        if tokens:
+            self.token_buffer.extend(tokens)
+            self.token_event.set()
+            self.stats.total_tokens_received += len(tokens)
+            self.progress[PROGRESS_TOKENS] += len(tokens)
 
-            channel = f"session:{self.session_id}"
-            subscription = self.centrifuge_client.new_subscription(channel, events=MySubscriptionHandler())
-            await subscription.subscribe()
+        if data.get("done"):
+            self.done_event.set()
 
-            return True
-
-        except Exception as e:
-            logger.error(f"Client connection failed. [client_id=%s, error=%s]", self.client_id, e)
-            self.stats.connection_errors += 1
-            return False
+    async def next_token(self) -> str:
+        while not self.token_buffer:
+            await self.token_event.wait()
+            self.token_event.clear()
+        return self.token_buffer.popleft()
 
     async def run_cycle(self, question: str):
         try:
+            # Drop leftovers from the previous cycle without awaiting, so nothing
+            # runs on the loop inside the latency measurement window.
             self.done_event.clear()
-            while not self.token_queue.empty():
-                await self.token_queue.get()
+            self.token_buffer.clear()
+            self.token_event.clear()
 
-            first_token_start = time.perf_counter()
+            first_token_start = _now()
 
-            request_start = time.perf_counter()
+            request_start = _now()
             response = await self.http_client.post(
                 "/api/run",
-                json={"session_id": self.session_id, "question": question}
+                content=orjson.dumps({**self.run_body_template, "question": question}),
+                headers=_JSON_HEADERS
             )
-            request_latency = time.perf_counter() - request_start
+            request_latency_ns = _now() - request_start
 
-            self.stats.request_latencies.append(request_latency)
+            self.stats.request_latencies.append(request_latency_ns)
             self.stats.total_requests += 1
 
-            first_token = await asyncio.wait_for(
-                self.token_queue.get(),
-                timeout=self.config.request_timeout
-            )
-            first_token_latency = time.perf_counter() - first_token_start
-            self.stats.token_latencies.append(first_token_latency)
+            # The body is never used; an error status means no stream will follow.
+            response.raise_for_status()
 
-            await asyncio.wait_for(
-                self.done_event.wait(),
-                timeout=self.config.request_timeout
-            )
+            async with asyncio.timeout(self.config.request_timeout):
+                first_token = await self.next_token()
+            first_token_latency_ns = _now() - first_token_start
+            self.stats.token_latencies.append(first_token_latency_ns)
+
+            async with asyncio.timeout(self.config.request_timeout):
+                await self.done_event.wait()
 
-            full_response = response.json()["response"]
             self.stats.cycles_completed += 1
+            self.progress[PROGRESS_CYCLES] += 1
 
-            return full_response
+            return True
 
         except asyncio.TimeoutError as e:
-            logger.error(f"Cycle timeout. [client_id=%s, session_id=%s, error=%s]", self.client_id, self.session_id, e)
+            logger.error("Cycle timeout. [client_id=%s, session_id=%s, error=%s]", self.client_id, self.session_id, e)
             self.stats.timeout_errors += 1
+            self.progress[PROGRESS_ERRORS] += 1
             return None
         except Exception as e:
-            logger.error(f"Cycle execution error. [client_id=%s, session_id=%s, error=%s]", self.client_id, self.session_id, e)
+            logger.error("Cycle execution error. [client_id=%s, session_id=%s, error=%s]", self.client_id, self.session_id, e)
             self.stats.other_errors += 1
+            self.progress[PROGRESS_ERRORS] += 1
             return None
 
     async def disconnect(self):
@@ -164,18 +294,20 @@ class EmulatorClient:
             try:
                 await self.http_client.delete(f"/api/sessions/{self.session_id}")
             except Exception as e:
-                logger.warning(f"Failed to close session. [session_id=%s, error=%s]", self.session_id, e)
-
-        if self.http_client:
-            await self.http_client.aclose()
+                logger.warning("Failed to close session. [session_id=%s, error=%s]", self.session_id, e)
 
         if self.centrifuge_client:
-            await self.centrifuge_client.disconnect()
+            try:
+                await self.centrifuge_client.disconnect()
+            except Exception as e:
+                logger.warning("Failed to disconnect client. [client_id=%s, error=%s]", self.client_id, e)
 
     async def run(self):
         self.stats.start_time = time.perf_counter()
 
         if not await self.connect():
+            # Stop background reconnects and drop the session created before the failure.
+            await self.disconnect()
             self.stats.end_time = time.perf_counter()
             return self.stats
 
@@ -183,9 +315,9 @@ class EmulatorClient:
             question = f"Question {cycle + 1} from client {self.client_id}"
             result = await self.run_cycle(question)
             if result is None:
-                logger.warning(f"Cycle failed. [client_id=%s, session_id=%s, cycle=%s]", self.client_id, self.session_id, cycle + 1)
+                logger.warning("Cycle failed. [client_id=%s, session_id=%s, cycle=%s]", self.client_id, self.session_id, cycle + 1)
             else:
-                logger.debug(f"Cycle completed successfully. [client_id=%s, session_id=%s, cycle=%s]", self.client_id, self.session_id, cycle + 1)
+                logger.debug("Cycle completed successfully. [client_id=%s, session_id=%s, cycle=%s]", self.client_id, self.session_id, cycle + 1)
 
         await self.disconnect()
         self.stats.end_time = time.perf_counter()
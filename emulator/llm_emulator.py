@@ -18,10 +18,15 @@ LOREM_IPSUM_WORDS = [
 ]
 
 
-def generate_lorem_ipsum(length: int = 100) -> str:
-    words = []
-    for _ in range(length):
-        words.append(random.choice(LOREM_IPSUM_WORDS))
+_WORDS_TUPLE = tuple(LOREM_IPSUM_WORDS)
+
+
+def generate_lorem_ipsum_tokens(length: int = 100) -> list[str]:
+    words = random.choices(_WORDS_TUPLE, k=length)
+    words[0] = words[0].capitalize()
+    words[-1] += "."
+    return words
 
-    text = " ".join(words)
-    return text[0].upper() + text[1:] + "."
\ No newline at end of file
+
+def generate_lorem_ipsum(length: int = 100) -> str:
+    return " ".join(generate_lorem_ipsum_tokens(length))
@@ -1,116 +1,306 @@
 import os
 import asyncio
+import base64
+import hashlib
+import hmac
+import inspect
+import itertools
 import logging
 import time
 import uuid
-from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.routing import APIRoute
+from fastapi.responses import ORJSONResponse, Response
 import httpx
-import jwt
+import msgspec
+import orjson
+import ormsgpack
 
-from emulator.llm_emulator import generate_lorem_ipsum
+from emulator.llm_emulator import generate_lorem_ipsum_tokens
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 CENTRIFUGO_API_URL = os.getenv("CENTRIFUGO_API_URL", "http://localhost:9001/api")
 CENTRIFUGO_API_KEY = os.getenv("CENTRIFUGO_API_KEY", "super-secret-api-key")
 JWT_SECRET = os.getenv("JWT_SECRET", "super-secret-jwt-key")
 RESPONSE_LENGTH_WORDS = int(os.getenv("RESPONSE_LENGTH_WORDS", "100"))
 TOKEN_DELAY_SECONDS = float(os.getenv("TOKEN_DELAY_SECONDS", "0.01"))
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "64"))
+PUBLISH_FLUSH_SECONDS = float(os.getenv("PUBLISH_FLUSH_MS", "5")) / 1000
+PUBLISHER_CONCURRENCY = int(os.getenv("PUBLISHER_CONCURRENCY", "8"))
+STREAM_BATCH_TOKENS = int(os.getenv("STREAM_BATCH_TOKENS", "8"))
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_MS", "50")) / 1000
+# Per granian worker process; the compose stack runs 4 containers x 6 workers.
+STREAM_WORKERS = int(os.getenv("STREAM_WORKERS", "128"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "16384"))
+CENTRIFUGO_HTTP2 = os.getenv("CENTRIFUGO_HTTP2", "true").lower() == "true"
+CENTRIFUGO_HEADERS = {
+    "Authorization": f"apikey {CENTRIFUGO_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+CENTRIFUGO_TIMEOUT = httpx.Timeout(
+    connect=5.0,
+    read=10.0,
+    write=10.0,
+    pool=5.0
+)
+
+# Publishes skip AsyncClient.build_request: URL, headers and timeout extension are prepared once.
+PUBLISH_URL = httpx.URL(CENTRIFUGO_API_URL.rstrip("/") + "/batch")
+PUBLISH_HEADERS = httpx.Headers(CENTRIFUGO_HEADERS)
+PUBLISH_EXTENSIONS = {"timeout": CENTRIFUGO_TIMEOUT.as_dict()}
+
+# Constant payloads, built once instead of per request/stream.
+HEALTH_OK = orjson.dumps({"status": "ok"})
+DONE_DATA = {"tokens": [], "done": True}
+BATCH_BODY_PREFIX = b'{"commands":'
+BATCH_BODY_SUFFIX = b'}'
+
+# Responses are generated once and rotated; the text is arbitrary lorem ipsum anyway.
+RESPONSE_POOL_SIZE = 16
+response_pool = itertools.cycle([
+    (tokens, " ".join(tokens))
+    for tokens in (generate_lorem_ipsum_tokens(length=RESPONSE_LENGTH_WORDS) for _ in range(RESPONSE_POOL_SIZE))
+])
+
+# HS256 JWT pieces that never change: the encoded header and the keyed HMAC state.
+JWT_HEADER_B64 = base64.urlsafe_b64encode(orjson.dumps({"alg": "HS256", "typ": "JWT"})).rstrip(b"=")
+JWT_HMAC = hmac.new(JWT_SECRET.encode(), digestmod=hashlib.sha256)
+# Claims with only sub/exp varying; session ids are uuid hex, so no JSON escaping is needed.
+JWT_PAYLOAD_TEMPLATE = b'{"sub":"%s","exp":%d,"channels":["session:%s"]}'
 
 http_client = None
-
-
-class RunRequest(BaseModel):
+# Whole-second wall clock refreshed by clock_ticker; JWT exp does not need finer resolution.
+now_seconds = int(time.time())
+clock_task = None
+# Publish failures are logged at most once per PUBLISH_ERROR_LOG_SECONDS; the rest are counted.
+PUBLISH_ERROR_LOG_SECONDS = 1.0
+publish_errors_suppressed = 0
+publish_error_logged_at = 0.0
+publish_queues: list[asyncio.Queue] = []
+publisher_tasks: list[asyncio.Task] = []
+stream_queue: asyncio.Queue = None
+stream_worker_tasks: list[asyncio.Task] = []
+
+
+class RunRequest(msgspec.Struct):
     session_id: str
     question: str
+    # Publish MessagePack payloads for clients on Centrifugo's protobuf protocol.
+    msgpack: bool = False
 
 
-class SessionCreateResponse(BaseModel):
+class SessionCreateResponse(msgspec.Struct):
     session_id: str
     token: str
 
 
+# Bodies are decoded and encoded with msgspec directly, bypassing FastAPI's pydantic validation.
+run_request_decoder = msgspec.json.Decoder(RunRequest)
+session_response_encoder = msgspec.json.Encoder()
+
+
 @app.on_event("startup")
 async def startup():
-    global http_client
+    global http_client, clock_task, publish_queues, publisher_tasks, stream_queue, stream_worker_tasks
+    if CENTRIFUGO_HTTP2:
+        # h2c with prior knowledge: httpcore multiplexes every request over one connection
+        # (up to HAProxy's 100 concurrent streams), so a larger pool would never be used.
+        max_keepalive, max_connections = 1, 1
+    else:
+        max_keepalive, max_connections = 500, 1000
     http_client = httpx.AsyncClient(
+        headers=CENTRIFUGO_HEADERS,
+        http1=not CENTRIFUGO_HTTP2,
+        http2=CENTRIFUGO_HTTP2,
         limits=httpx.Limits(
-            max_keepalive_connections=500,
-            max_connections=1000,
+            max_keepalive_connections=max_keepalive,
+            max_connections=max_connections,
             keepalive_expiry=30.0
         ),
-        timeout=httpx.Timeout(
-            connect=5.0,
-            read=10.0,
-            write=10.0,
-            pool=5.0
-        )
+        timeout=CENTRIFUGO_TIMEOUT
     )
-    logger.info("HTTP client initialized. [max_keepalive=500, max_connections=1000, keepalive_expiry=30s]")
+    logger.info(
+        "HTTP client initialized. [http2=%s, max_keepalive=%s, max_connections=%s, keepalive_expiry=30s]",
+        CENTRIFUGO_HTTP2, max_keepalive, max_connections
+    )
+
+    clock_task = asyncio.create_task(clock_ticker())
+    publish_queues = [asyncio.Queue() for _ in range(PUBLISHER_CONCURRENCY)]
+    publisher_tasks = [asyncio.create_task(publisher(queue)) for queue in publish_queues]
+
+    stream_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stream_worker_tasks = [asyncio.create_task(stream_worker(stream_queue)) for _ in range(STREAM_WORKERS)]
 
 
 @app.on_event("shutdown")
 async def shutdown():
     global http_client
+    if clock_task:
+        clock_task.cancel()
+    for task in stream_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*stream_worker_tasks, return_exceptions=True)
+    if stream_queue is not None and stream_queue.qsize():
+        logger.warning("Dropping queued token streams on shutdown. [count=%s]", stream_queue.qsize())
+
+    for task in publisher_tasks:
+        task.cancel()
+    await asyncio.gather(*publisher_tasks, return_exceptions=True)
+    # Streams are stopped, so whatever is still queued is the last of their publications.
+    for queue in publish_queues:
+        while not queue.empty():
+            batch = [queue.get_nowait() for _ in range(min(PUBLISH_BATCH_SIZE, queue.qsize()))]
+            await publish_to_centrifugo(batch)
+
     if http_client:
         await http_client.aclose()
         logger.info("HTTP client closed")
 
 
-async def publish_to_centrifugo(channel: str, data: dict):
+async def clock_ticker():
+    global now_seconds
+    while True:
+        await asyncio.sleep(1)
+        now_seconds = int(time.time())
+
+
+def encode_session_token(payload: bytes) -> str:
+    payload_b64 = base64.urlsafe_b64encode(payload).rstrip(b"=")
+    signing_input = JWT_HEADER_B64 + b"." + payload_b64
+    signature = JWT_HMAC.copy()
+    signature.update(signing_input)
+    return (signing_input + b"." + base64.urlsafe_b64encode(signature.digest()).rstrip(b"=")).decode()
+
+
+def publish_command(channel: str, data: dict, binary: bool = False) -> dict:
+    if binary:
+        return {"publish": {"channel": channel, "b64data": base64.b64encode(ormsgpack.packb(data)).decode()}}
+    return {"publish": {"channel": channel, "data": data}}
+
+
+def enqueue_publication(channel: str, data: dict, binary: bool = False):
+    # A channel always maps to the same publisher, which keeps its publications in order.
+    publish_queues[hash(channel) % len(publish_queues)].put_nowait(publish_command(channel, data, binary))
+
+
+def log_publish_failure(message: str, *args):
+    # At most one failure line per PUBLISH_ERROR_LOG_SECONDS; the rest are counted.
+    global publish_errors_suppressed, publish_error_logged_at
+    now = time.monotonic()
+    if now - publish_error_logged_at < PUBLISH_ERROR_LOG_SECONDS:
+        publish_errors_suppressed += 1
+        return
+    if publish_errors_suppressed:
+        logger.error("Publish failures suppressed. [count=%s]", publish_errors_suppressed)
+    publish_errors_suppressed = 0
+    publish_error_logged_at = now
+    logger.error(message, *args)
+
+
+async def publish_to_centrifugo(commands: list[dict]):
+    # One batch request per call; Centrifugo still delivers one publication per command.
     try:
-        await http_client.post(
-            CENTRIFUGO_API_URL,
-            json={
-                "method": "publish",
-                "params": {"channel": channel, "data": data}
-            },
-            headers={"Authorization": f"apikey {CENTRIFUGO_API_KEY}"}
-        )
+        response = await http_client.send(httpx.Request(
+            "POST",
+            PUBLISH_URL,
+            headers=PUBLISH_HEADERS,
+            content=BATCH_BODY_PREFIX + orjson.dumps(commands) + BATCH_BODY_SUFFIX,
+            extensions=PUBLISH_EXTENSIONS
+        ))
+        response.raise_for_status()
+        reply = orjson.loads(response.content)
     except Exception as e:
-        logger.error(f"Failed to publish to Centrifugo. [channel=%s, error=%s]", channel, e)
+        log_publish_failure("Failed to publish to Centrifugo. [commands=%s, error=%s]", len(commands), e)
+        return
+
+    if "error" in reply:
+        log_publish_failure("Centrifugo rejected publish batch. [commands=%s, error=%s]", len(commands), reply["error"])
+        return
+    errors = [r["error"] for r in reply.get("replies", ()) if "error" in r]
+    if errors:
+        log_publish_failure(
+            "Centrifugo rejected publications. [commands=%s, failed=%s, error=%s]",
+            len(commands), len(errors), errors[0]
+        )
+
+
+async def publisher(queue: asyncio.Queue):
+    """Coalesce queued publications from many sessions into Centrifugo batch requests.
+
+    A batch is flushed when it reaches PUBLISH_BATCH_SIZE commands or PUBLISH_FLUSH_SECONDS
+    after its first command, whichever comes first. PUBLISHER_CONCURRENCY publishers run side
+    by side, so up to that many batches are in flight; each sends its own batches serially.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + PUBLISH_FLUSH_SECONDS
+        while len(batch) < PUBLISH_BATCH_SIZE:
+            try:
+                batch.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                async with asyncio.timeout(timeout):
+                    batch.append(await queue.get())
+            except TimeoutError:
+                break
+        await publish_to_centrifugo(batch)
+
+
+async def stream_worker(queue: asyncio.Queue):
+    # Long-lived stream runner; STREAM_WORKERS of these bound how many streams run at once.
+    while True:
+        channel, tokens, binary = await queue.get()
+        try:
+            await stream_tokens_background(channel, tokens, binary)
+        except Exception as e:
+            logger.error("Token stream failed. [channel=%s, error=%s]", channel, e)
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return Response(content=HEALTH_OK, media_type="application/json")
 
 
-@app.post("/api/sessions/create", response_model=SessionCreateResponse)
+@app.post("/api/sessions/create")
 async def create_session():
-    session_id = str(uuid.uuid4())
+    session_id = uuid.uuid4().hex
     channel = f"session:{session_id}"
 
-    payload = {
-        "sub": session_id,
-        "exp": int(time.time()) + 3600,
-        "channels": [channel]
-    }
-    token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
+    session_id_bytes = session_id.encode()
+    token = encode_session_token(JWT_PAYLOAD_TEMPLATE % (session_id_bytes, now_seconds + 3600, session_id_bytes))
 
     try:
         await http_client.post(
             CENTRIFUGO_API_URL,
-            json={
+            content=orjson.dumps({
                 "method": "subscribe",
                 "params": {
                     "user": session_id,
                     "channel": channel
                 }
-            },
-            headers={"Authorization": f"apikey {CENTRIFUGO_API_KEY}"}
+            })
         )
         logger.debug(f"User subscribed to channel. [session_id=%s, channel=%s]", session_id, channel)
     except Exception as e:
         logger.error(f"Failed to subscribe user. [session_id=%s, error=%s]", session_id, e)
 
     logger.info(f"Session created. [session_id=%s]", session_id)
-    return SessionCreateResponse(session_id=session_id, token=token)
+    return Response(
+        content=session_response_encoder.encode(SessionCreateResponse(session_id=session_id, token=token)),
+        media_type="application/json"
+    )
 
 
 @app.delete("/api/sessions/{session_id}")
@@ -120,11 +310,10 @@ async def close_session(session_id: str):
     try:
         await http_client.post(
             CENTRIFUGO_API_URL,
-            json={
+            content=orjson.dumps({
                 "method": "history_remove",
                 "params": {"channel": channel}
-            },
-            headers={"Authorization": f"apikey {CENTRIFUGO_API_KEY}"}
+            })
         )
         logger.info(f"Session closed and channel history removed. [session_id=%s, channel=%s]", session_id, channel)
     except Exception as e:
@@ -133,22 +322,64 @@ async def close_session(session_id: str):
     return {"status": "closed"}
 
 
-async def stream_tokens_background(channel: str, tokens: list[str]):
-    for token in tokens:
-        await publish_to_centrifugo(channel, {"token": token})
-        await asyncio.sleep(TOKEN_DELAY_SECONDS)
-
-    await publish_to_centrifugo(channel, {"done": True})
+async def stream_tokens_background(channel: str, tokens: list[str], binary: bool = False):
+    """Publish tokens at TOKEN_DELAY_SECONDS pacing, several per publication.
+
+    The first token goes out alone so first-token latency stays meaningful; the rest are
+    flushed every STREAM_BATCH_TOKENS tokens or STREAM_FLUSH_SECONDS, whichever comes first.
+    Token times follow a fixed schedule from the stream start, so sleep overshoot does not
+    accumulate as drift.
+    """
+    if not tokens:
+        enqueue_publication(channel, DONE_DATA, binary)
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time()
+    # Wall-clock send time lets clients measure delivery latency on their side.
+    enqueue_publication(channel, {"tokens": [tokens[0]], "ts": time.time_ns()}, binary)
+    deadline += TOKEN_DELAY_SECONDS
+    await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    buffer = []
+    flush_at = 0.0
+    for token in tokens[1:]:
+        if not buffer:
+            flush_at = loop.time() + STREAM_FLUSH_SECONDS
+        buffer.append(token)
+        if len(buffer) >= STREAM_BATCH_TOKENS or loop.time() >= flush_at:
+            enqueue_publication(channel, {"tokens": buffer}, binary)
+            buffer = []
+        deadline += TOKEN_DELAY_SECONDS
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    if buffer:
+        enqueue_publication(channel, {"tokens": buffer, "done": True}, binary)
+    else:
+        enqueue_publication(channel, DONE_DATA, binary)
 
 
 @app.post("/api/run")
-async def run(request: RunRequest):
+async def run(http_request: Request):
+    try:
+        request = run_request_decoder.decode(await http_request.body())
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     session_id = request.session_id
     channel = f"session:{session_id}"
 
-    full_response = generate_lorem_ipsum(length=RESPONSE_LENGTH_WORDS)
-    tokens = full_response.split()
+    tokens, full_response = next(response_pool)
 
-    asyncio.create_task(stream_tokens_background(channel, tokens))
+    # Waits only when STREAM_QUEUE_SIZE streams are already pending.
+    await stream_queue.put((channel, tokens, request.msgpack))
 
     return {"response": full_response}
+
+
+# FastAPI runs sync endpoints in a threadpool; keep every route on the event loop.
+for route in app.routes:
+    if isinstance(route, APIRoute) and not inspect.iscoroutinefunction(route.endpoint):
+        raise RuntimeError(f"Route endpoint must be async. [path={route.path}, endpoint={route.endpoint.__name__}]")
@@ -1,4 +1,5 @@
 import logging
+from array import array
 from dataclasses import dataclass, field
 import numpy as np
 
@@ -6,13 +7,22 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+def _merge_ms(samples: list[array]) -> np.ndarray:
+    # Zero-copy views over each client's int64 buffer, joined in one concatenate.
+    merged = np.concatenate([np.frombuffer(s, dtype=np.int64) for s in samples])
+    return merged / 1_000_000 if merged.size else np.array([0])
+
+
 @dataclass
 class ClientStats:
     client_id: int
     session_id: str
 
-    request_latencies: list[float] = field(default_factory=list)
-    token_latencies: list[float] = field(default_factory=list)
+    # Latencies in nanoseconds (time.monotonic_ns deltas).
+    request_latencies: array = field(default_factory=lambda: array('q'))
+    token_latencies: array = field(default_factory=lambda: array('q'))
+    # Server publish to client receive of the first token (wall clock, nanoseconds).
+    delivery_latencies: array = field(default_factory=lambda: array('q'))
 
     cycles_completed: int = 0
     total_tokens_received: int = 0
@@ -46,6 +56,10 @@ class AggregatedStats:
     token_latency_p95: float
     token_latency_p99: float
 
+    delivery_latency_p50: float
+    delivery_latency_p95: float
+    delivery_latency_p99: float
+
     successful_connections: int
     failed_connections: int
     total_errors: int
@@ -60,11 +74,10 @@ class AggregatedStats:
                 request_latency_p50=0, request_latency_p95=0,
                 request_latency_p99=0, request_latency_max=0,
                 token_latency_p50=0, token_latency_p95=0, token_latency_p99=0,
+                delivery_latency_p50=0, delivery_latency_p95=0, delivery_latency_p99=0,
                 successful_connections=0, failed_connections=0, total_errors=0, total_reconnections=0
             )
 
-        all_request_latencies = []
-        all_token_latencies = []
         total_tokens = 0
         total_requests = 0
         total_errors = 0
@@ -77,8 +90,6 @@ class AggregatedStats:
 
         total_reconnections = 0
         for stats in client_stats:
-            all_request_latencies.extend(stats.request_latencies)
-            all_token_latencies.extend(stats.token_latencies)
             total_tokens += stats.total_tokens_received
             total_requests += stats.total_requests
             total_errors += stats.connection_errors + stats.timeout_errors + stats.other_errors
@@ -89,8 +100,14 @@ class AggregatedStats:
             else:
                 failed += 1
 
-        req_lat_ms = np.array(all_request_latencies) * 1000 if all_request_latencies else np.array([0])
-        tok_lat_ms = np.array(all_token_latencies) * 1000 if all_token_latencies else np.array([0])
+        req_lat_ms = _merge_ms([s.request_latencies for s in client_stats])
+        tok_lat_ms = _merge_ms([s.token_latencies for s in client_stats])
+        dlv_lat_ms = _merge_ms([s.delivery_latencies for s in client_stats])
+
+        # One call per series shares a single partition of the data across percentiles.
+        req_p50, req_p95, req_p99, req_max = np.percentile(req_lat_ms, [50, 95, 99, 100]).tolist()
+        tok_p50, tok_p95, tok_p99 = np.percentile(tok_lat_ms, [50, 95, 99]).tolist()
+        dlv_p50, dlv_p95, dlv_p99 = np.percentile(dlv_lat_ms, [50, 95, 99]).tolist()
 
         return cls(
             total_clients=len(client_stats),
@@ -99,13 +116,16 @@ class AggregatedStats:
             requests_per_second=total_requests / duration if duration > 0 else 0,
             tokens_per_second=total_tokens / duration if duration > 0 else 0,
             cycles_per_second=sum(s.cycles_completed for s in client_stats) / duration if duration > 0 else 0,
-            request_latency_p50=float(np.percentile(req_lat_ms, 50)),
-            request_latency_p95=float(np.percentile(req_lat_ms, 95)),
-            request_latency_p99=float(np.percentile(req_lat_ms, 99)),
-            request_latency_max=float(np.max(req_lat_ms)),
-            token_latency_p50=float(np.percentile(tok_lat_ms, 50)),
-            token_latency_p95=float(np.percentile(tok_lat_ms, 95)),
-            token_latency_p99=float(np.percentile(tok_lat_ms, 99)),
+            request_latency_p50=req_p50,
+            request_latency_p95=req_p95,
+            request_latency_p99=req_p99,
+            request_latency_max=req_max,
+            token_latency_p50=tok_p50,
+            token_latency_p95=tok_p95,
+            token_latency_p99=tok_p99,
+            delivery_latency_p50=dlv_p50,
+            delivery_latency_p95=dlv_p95,
+            delivery_latency_p99=dlv_p99,
             successful_connections=successful,
             failed_connections=failed,
             total_errors=total_errors,
@@ -132,6 +152,10 @@ class AggregatedStats:
         logger.info("  [p50=%.2f, p95=%.2f, p99=%.2f]",
                    self.token_latency_p50, self.token_latency_p95, self.token_latency_p99)
         logger.info("")
+        logger.info("DELIVERY LATENCY (ms, server publish to client receive):")
+        logger.info("  [p50=%.2f, p95=%.2f, p99=%.2f]",
+                   self.delivery_latency_p50, self.delivery_latency_p95, self.delivery_latency_p99)
+        logger.info("")
         logger.info("CONNECTIONS:")
         logger.info("  [successful=%s, failed=%s, total_errors=%s, reconnections=%s]",
                    self.successful_connections, self.failed_connections, self.total_errors, self.total_reconnections)
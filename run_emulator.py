@@ -1,19 +1,31 @@
 import argparse
 import asyncio
+import atexit
 import logging
+import queue
 import signal
 import sys
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 import uvloop
 
 from emulator.config import EmulatorConfig
-from emulator.emulator_client import EmulatorClient
+from emulator.emulator_client import (
+    PROGRESS_CYCLES,
+    PROGRESS_ERRORS,
+    PROGRESS_TOKENS,
+    EmulatorClient,
+    new_progress_counters,
+)
 from emulator.statistics import AggregatedStats
 
 
 logger = logging.getLogger(__name__)
 
+# Clients are started this many at a time; the ramp delay applies between batches.
+LAUNCH_BATCH_SIZE = 64
+
 def setup_logging(num_clients: int, cycles: int):
     logs_dir = Path("logs")
     logs_dir.mkdir(exist_ok=True)
@@ -33,9 +45,15 @@ def setup_logging(num_clients: int, cycles: int):
         logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     )
 
+    # File and console writes happen on the listener thread, not on the event loop.
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
     logging.basicConfig(
         level=logging.INFO,
-        handlers=[file_handler, console_handler]
+        handlers=[QueueHandler(log_queue)]
     )
 
     logger.info(f"Logging to file. [log_file=%s]", log_file)
@@ -46,57 +64,60 @@ class EmulatorOrchestrator:
     def __init__(self, config: EmulatorConfig):
         self.config = config
         self.clients_stats = []
+        self.progress_counters = new_progress_counters()
         self.running = True
-        self.progress_task = None
-
-    async def log_progress(self):
-        while self.running:
-            await asyncio.sleep(10)
-            if self.clients_stats:
-                total_cycles = sum(s.cycles_completed for s in self.clients_stats)
-                total_tokens = sum(s.total_tokens_received for s in self.clients_stats)
-                total_errors = sum(
-                    s.connection_errors + s.timeout_errors + s.other_errors
-                    for s in self.clients_stats
-                )
-                logger.info(
-                    f"Test progress. [cycles=%s, tokens=%s, errors=%s]",
-                    total_cycles, total_tokens, total_errors
-                )
+        self.progress_timer = None
+        # Strong references for fire-and-forget tasks; the loop only keeps weak ones.
+        self.background_tasks = set()
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def log_progress(self):
+        # Plain loop timer callback that re-arms itself; no coroutine per tick.
+        if not self.running:
+            return
+        logger.info(
+            "Test progress. [cycles=%s, tokens=%s, errors=%s]",
+            self.progress_counters[PROGRESS_CYCLES],
+            self.progress_counters[PROGRESS_TOKENS],
+            self.progress_counters[PROGRESS_ERRORS]
+        )
+        self.progress_timer = asyncio.get_running_loop().call_later(10, self.log_progress)
 
     async def run_client(self, client_id: int):
-        client = EmulatorClient(client_id, self.config)
-        stats = await client.run()
-        self.clients_stats.append(stats)
-        return stats
+        client = EmulatorClient(client_id, self.config, self.progress_counters)
+        return await client.run()
 
     async def run(self):
         logger.info(f"Emulator starting. [num_clients=%s, cycles_per_client=%s]",
                    self.config.num_clients, self.config.cycles_per_client)
 
         # Start progress logging
-        self.progress_task = asyncio.create_task(self.log_progress())
+        self.progress_timer = asyncio.get_running_loop().call_later(10, self.log_progress)
 
-        # Launch clients with optional ramp delay to avoid thundering herd
+        # Launch clients in batches with optional ramp delay to avoid thundering herd
+        num_clients = self.config.num_clients
+        batch_size = max(1, min(LAUNCH_BATCH_SIZE, num_clients))
         tasks = []
-        for client_id in range(self.config.num_clients):
-            tasks.append(asyncio.create_task(self.run_client(client_id)))
-            if self.config.client_ramp_delay_ms > 0 and client_id + 1 < self.config.num_clients:
+        for batch_start in range(0, num_clients, batch_size):
+            batch_end = min(batch_start + batch_size, num_clients)
+            tasks.extend(asyncio.create_task(self.run_client(client_id)) for client_id in range(batch_start, batch_end))
+            if self.config.client_ramp_delay_ms > 0 and batch_end < num_clients:
                 await asyncio.sleep(self.config.client_ramp_delay_ms / 1000.0)
 
         try:
-            await asyncio.gather(*tasks)
+            self.clients_stats = await asyncio.gather(*tasks)
         except KeyboardInterrupt:
             logger.info("Test interrupted by user.")
             self.running = False
         finally:
             self.running = False
-            if self.progress_task:
-                self.progress_task.cancel()
-                try:
-                    await self.progress_task
-                except asyncio.CancelledError:
-                    pass
+            await EmulatorClient.close_shared_client()
+            if self.progress_timer:
+                self.progress_timer.cancel()
 
         # Aggregate and print statistics
         aggregated = AggregatedStats.from_client_stats(self.clients_stats)
@@ -114,7 +135,13 @@ def parse_args():
     parser.add_argument('--delay', type=float, default=0.01,
                        help='Token delay in seconds (default: 0.01)')
     parser.add_argument('--ramp-delay-ms', type=int, default=0,
-                       help='Delay in milliseconds between client startups (default: 0)')
+                       help='Delay in milliseconds between batches of 64 client startups (default: 0)')
+    parser.add_argument('--max-concurrent', type=int, default=50,
+                       help='Max clients connecting at the same time (default: 50)')
+    parser.add_argument('--http2', action=argparse.BooleanOptionalAction, default=True,
+                       help='Multiplex API requests over HTTP/2 (default: enabled)')
+    parser.add_argument('--msgpack', action=argparse.BooleanOptionalAction, default=True,
+                       help='Receive MessagePack token payloads over the protobuf protocol (default: enabled)')
     return parser.parse_args()
 
 
@@ -129,6 +156,9 @@ async def main():
         response_length_words=args.length,
         token_delay_seconds=args.delay,
         client_ramp_delay_ms=args.ramp_delay_ms,
+        max_concurrent_clients=args.max_concurrent,
+        http2=args.http2,
+        use_msgpack=args.msgpack,
     )
 
     orchestrator = EmulatorOrchestrator(config)
@@ -141,6 +171,16 @@ async def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
+    # SIGHUP doubles the connect admission limit of a running test.
+    async def raise_connect_limit():
+        config.max_concurrent_clients *= 2
+        await EmulatorClient.resize_connect_slots(config, config.max_concurrent_clients)
+        logger.info("Connect limit raised. [max_concurrent=%s]", config.max_concurrent_clients)
+
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, lambda: orchestrator.spawn(raise_connect_limit())
+    )
+
     await orchestrator.run()
 
 
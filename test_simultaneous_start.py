@@ -1,5 +1,6 @@
 import asyncio
 import time
+import uvloop
 from emulator.config import EmulatorConfig
 from emulator.emulator_client import EmulatorClient
 
@@ -24,6 +25,7 @@ async def test_simultaneous_start():
 
     print("Launching all clients with asyncio.gather()...")
     await asyncio.gather(*tasks)
+    await EmulatorClient.close_shared_client()
 
     if start_times:
         start_times.sort(key=lambda x: x[1])
@@ -44,4 +46,5 @@ async def test_simultaneous_start():
             print(f"⚠️  Clients started over {spread:.0f}ms - NOT simultaneous")
 
 if __name__ == "__main__":
+    uvloop.install()
     asyncio.run(test_simultaneous_start())
@@ -1,4 +1,4 @@
-import { Centrifuge, PublicationContext, Subscription } from 'centrifuge';
+import { Centrifuge, PublicationContext } from 'centrifuge';
 import type { EmulatorConfig } from './config';
 import { ClientStats } from './statistics';
 import { getLogger } from './logger';
@@ -11,7 +11,6 @@ export class EmulatorClient {
   private sessionId: string = '';
   private token: string = '';
   private centrifuge: Centrifuge | null = null;
-  private subscription: Subscription | null = null;
   private stats: ClientStats;
   private tokenQueue: string[] = [];
   private tokenResolvers: Array<() => void> = [];
@@ -64,13 +63,15 @@ export class EmulatorClient {
         const data = ctx.data;
         logger.debug(`Server publication received. [client_id=${this.clientId}, session_id=${this.sessionId}]`);
 
-        if (data.token) {
-          this.tokenQueue.push(data.token);
-          this.stats.totalTokensReceived++;
+        if (Array.isArray(data.tokens)) {
+          for (const token of data.tokens) {
+            this.tokenQueue.push(token);
+            this.stats.totalTokensReceived++;
 
-          if (this.tokenResolvers.length > 0) {
-            const resolve = this.tokenResolvers.shift();
-            resolve?.();
+            if (this.tokenResolvers.length > 0) {
+              const resolve = this.tokenResolvers.shift();
+              resolve?.();
+            }
           }
         }
 
@@ -79,32 +80,9 @@ export class EmulatorClient {
         }
       });
 
+      // The token's channels claim subscribes us server-side on connect.
       this.centrifuge.connect();
 
-      const channel = `session:${this.sessionId}`;
-      this.subscription = this.centrifuge.newSubscription(channel);
-
-      this.subscription.on('publication', (ctx: PublicationContext) => {
-        const data = ctx.data;
-        logger.debug(`Publication received. [client_id=${this.clientId}, session_id=${this.sessionId}]`);
-
-        if (data.token) {
-          this.tokenQueue.push(data.token);
-          this.stats.totalTokensReceived++;
-
-          if (this.tokenResolvers.length > 0) {
-            const resolve = this.tokenResolvers.shift();
-            resolve?.();
-          }
-        }
-
-        if (data.done && this.doneResolve) {
-          this.doneResolve();
-        }
-      });
-
-      this.subscription.subscribe();
-
       return true;
 
     } catch (error) {
@@ -187,13 +165,6 @@ export class EmulatorClient {
   }
 
   async disconnect(): Promise<void> {
-    // Unsubscribe from channel
-    if (this.subscription) {
-      this.subscription.unsubscribe();
-      this.subscription.removeAllListeners();
-      this.subscription = null;
-    }
-
     // Disconnect Centrifuge client
     if (this.centrifuge) {
       this.centrifuge.removeAllListeners();